@@ -10,6 +10,7 @@ from azureml.core.authentication import ServicePrincipalAuthentication
 import dotenv
 from sklearn import datasets
 
+from instrumentation import trace
 from utils import execute_cli_command, start_action, end_action, wait, request_user_consent
 
 
@@ -124,9 +125,12 @@ def create_resource_group(resource_group_name: str):
                             f' --name {resource_group_name}' +
                             f' --location westeurope')
 
+    end_action(action_text)
+
 
 def create_azure_ml_workspace(resource_group_name: str, aml_workspace_name: str) -> (str, str):
     action_text = f'Create Azure Machine Learning Workspace "{aml_workspace_name}" and supportive resources'
+    start_action(action_text)
 
     aml_workspace = execute_cli_command(f'az ml workspace create ' +
                                         f' --resource-group {resource_group_name}' +
@@ -279,9 +283,11 @@ def save_configuration_in_environment(subscription_id: str, resource_group_name:
     dotenv.set_key(dotenv_file, 'AMLW_CLIENT_APP_ID', app_reg_app_id)
     dotenv.set_key(dotenv_file, 'AMLW_CLIENT_PASSWORD', app_reg_password)
     dotenv.set_key(dotenv_file, 'MODEL_NAME', 'digit-classifier')
+    dotenv.set_key(dotenv_file, 'CLEANUP_COMPLETED_STEPS', '')
 
     end_action(action_text)
 
 
 if __name__ == '__main__':
-    main()
+    with trace('1_resource_creator'):
+        main()
@@ -1,24 +1,131 @@
+import argparse
+import copy
+import json
 import os
+import time
 
 from azureml.core import Workspace, Dataset
 from azureml.core.authentication import ServicePrincipalAuthentication
 from dotenv import load_dotenv
 import mlflow
 import mlflow.sklearn
+from mlflow.tracking import MlflowClient
+import pandas as pd
 from sklearn.metrics import (
     accuracy_score, f1_score, precision_score, recall_score, classification_report,
     confusion_matrix, ConfusionMatrixDisplay
 )
-from sklearn.model_selection import GridSearchCV
+from sklearn.base import clone
+from sklearn.model_selection import GridSearchCV, StratifiedKFold
 from sklearn.neural_network import MLPClassifier
 from sklearn.preprocessing import StandardScaler
 
+from hyperparameters import PARAM_GRID, CV_FOLDS, PRIMARY_METRIC, argument_type, to_argument_name
+from instrumentation import MlflowSink, instrumented, trace
 from utils import start_action, end_action, matplotlib_figure_to_pillow_image
 
 load_dotenv('./.env')
 
+TRAIN_DATASET_NAME = 'MNIST Database - Train Partition'
+TEST_DATASET_NAME = 'MNIST Database - Test Partition'
+TRAINING_INFO_FILE_NAME = 'training_info.json'
+
 
 def main():
+    args = parse_arguments()
+
+    mlflow.start_run()
+    with trace('2_training', MlflowSink()):
+        train(args)
+    mlflow.end_run()
+
+
+def train(args: argparse.Namespace):
+    if args.mode == 'register':
+        digit_classifier, training_info = load_trained_model(args.model_input)
+        log_training_info(training_info)
+        export_model(digit_classifier)
+        return
+
+    workspace = connect_to_workspace()
+
+    if args.mode == 'incremental':
+        retrain_incrementally(workspace, args.epochs, args.max_accuracy_drop)
+        return
+
+    x_test, x_train, y_test, y_train, train_dataset_version = fetch_and_scale_data(workspace)
+
+    if args.mode == 'trial':
+        digit_classifier, refit_seconds = train_trial(x_train, y_train, trial_hyperparameters(args))
+    else:
+        mlflow.sklearn.autolog()
+        digit_classifier, refit_seconds = tune_hyperparameters(x_train, y_train)
+    training_info = {
+        'train_dataset_version': train_dataset_version,
+        'refit_seconds': refit_seconds,
+    }
+
+    analyze_model(digit_classifier, x_test, y_test)
+    log_training_info(training_info)
+
+    if args.mode == 'trial':
+        save_trial_model(digit_classifier, training_info, args.model_output)
+    else:
+        export_model(digit_classifier)
+
+
+@instrumented('Incremental retraining')
+def retrain_incrementally(workspace: Workspace, epochs: int, max_accuracy_drop: float):
+    baseline_classifier, baseline_info = load_latest_registered_model()
+
+    x_test, x_new, y_test, y_new, train_dataset_version = fetch_and_scale_data(
+        workspace, baseline_train_dataset_version=baseline_info['train_dataset_version']
+    )
+    if len(y_new) == 0:
+        end_action('Skipped incremental retraining, no new or changed rows', state='skipped')
+        return
+
+    training_start = time.perf_counter()
+    digit_classifier = continue_training(copy.deepcopy(baseline_classifier), x_new, y_new, epochs)
+    report_time_saved(time.perf_counter() - training_start, baseline_info['refit_seconds'])
+
+    analyze_model(digit_classifier, x_test, y_test)
+
+    if validate_against_baseline(baseline_classifier, digit_classifier, x_test, y_test, max_accuracy_drop):
+        log_training_info({
+            'train_dataset_version': train_dataset_version,
+            'refit_seconds': baseline_info['refit_seconds'],
+        })
+        export_model(digit_classifier)
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Train the digit classifier')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.add_parser('grid', help='Grid search over all hyperparameters within this job (default)')
+
+    trial_parser = subparsers.add_parser('trial', help='Train a single sweep trial')
+    for name, values in PARAM_GRID.items():
+        trial_parser.add_argument(to_argument_name(name), dest=name, type=argument_type(values), required=True)
+    trial_parser.add_argument('--model-output', required=True)
+
+    register_parser = subparsers.add_parser('register', help='Register the model of the best sweep trial')
+    register_parser.add_argument('--model-input', required=True)
+
+    incremental_parser = subparsers.add_parser(
+        'incremental', help='Continue training the latest registered model on new or changed rows only'
+    )
+    incremental_parser.add_argument('--epochs', type=int, default=10,
+                                    help='Passes over the new rows (iterations for the lbfgs solver)')
+    incremental_parser.add_argument('--max-accuracy-drop', type=float, default=0.005,
+                                    help='Tolerated test accuracy drop compared with the latest registered model')
+
+    args = parser.parse_args()
+    args.mode = args.mode or 'grid'
+    return args
+
+
+def connect_to_workspace() -> Workspace:
     subscription_id = os.getenv('SUBSCRIPTION_ID')
     resource_group = os.getenv('RESOURCE_GROUP')
     workspace_name = os.getenv('AML_WORKSPACE_NAME')
@@ -26,58 +133,131 @@ def main():
     app_id = os.getenv('AMLW_CLIENT_APP_ID')
     app_password = os.getenv('AMLW_CLIENT_PASSWORD')
 
-    workspace = Workspace(subscription_id, resource_group, workspace_name, auth=ServicePrincipalAuthentication(
+    return Workspace(subscription_id, resource_group, workspace_name, auth=ServicePrincipalAuthentication(
         tenant_id=tenant_id, service_principal_id=app_id, service_principal_password=app_password
     ))
 
-    mlflow.start_run()
-    mlflow.sklearn.autolog()
 
-    x_test, x_train, y_test, y_train = fetch_and_scale_data(workspace)
+def trial_hyperparameters(args: argparse.Namespace) -> dict:
+    return {name: getattr(args, name) for name in PARAM_GRID}
 
-    digit_classifier = tune_hyperparameters(x_train, y_train)
 
-    analyze_model(digit_classifier, x_test, y_test)
-
-    export_model(digit_classifier)
-
-    mlflow.end_run()
+def fetch_and_scale_data(workspace, baseline_train_dataset_version: str = None):
+    action_text = 'Fetch and scale data'
+    span_name = action_text
+    if baseline_train_dataset_version is not None:
+        action_text += f' added since version {baseline_train_dataset_version} of the training set'
+        mlflow.set_tag('baseline_train_dataset_version', baseline_train_dataset_version)
+    start_action(action_text, span_name=span_name)
 
+    train_dataset = Dataset.get_by_name(workspace, name=TRAIN_DATASET_NAME)
+    train = train_dataset.to_pandas_dataframe()
+    test = Dataset.get_by_name(workspace, name=TEST_DATASET_NAME).to_pandas_dataframe()
 
-def fetch_and_scale_data(workspace):
-    action_text = 'Fetch and scale data'
-    start_action(action_text)
+    # the scaler always sees the full training set, the same way the test client scales its samples
+    scaler = StandardScaler().fit(train.loc[:, train.columns != 'label'])
 
-    train = Dataset.get_by_name(workspace, name='MNIST Database - Train Partition').to_pandas_dataframe()
-    test = Dataset.get_by_name(workspace, name='MNIST Database - Test Partition').to_pandas_dataframe()
+    if baseline_train_dataset_version is not None:
+        baseline = Dataset.get_by_name(workspace, name=TRAIN_DATASET_NAME,
+                                       version=baseline_train_dataset_version).to_pandas_dataframe()
+        train = select_new_or_changed_rows(train, baseline)
 
     x_train, x_test = train.loc[:, train.columns != 'label'], test.loc[:, test.columns != 'label']
     y_train, y_test = train[['label']].values.ravel(), test[['label']].values.ravel()
 
-    scaler = StandardScaler().fit(x_train)
     x_train, x_test = scaler.transform(x_train), scaler.transform(x_test)
 
     end_action(action_text)
-    return x_test, x_train, y_test, y_train
+    return x_test, x_train, y_test, y_train, str(train_dataset.version)
 
 
-def tune_hyperparameters(x_train, y_train):
-    param_grid = {
-        'hidden_layer_sizes': [(100,), (125,), (100, 100)],
-        'activation': ['logistic', 'relu'],
-        'solver': ['lbfgs'],
-        'alpha': [1E-4, 1E-3],
+def select_new_or_changed_rows(train: pd.DataFrame, baseline: pd.DataFrame) -> pd.DataFrame:
+    # hashing includes the label, so relabeled digits count as changed rows
+    baseline_row_hashes = set(pd.util.hash_pandas_object(baseline, index=False))
+    return train[~pd.util.hash_pandas_object(train, index=False).isin(baseline_row_hashes)]
 
-        'max_iter': [500],
-    }
+
+def tune_hyperparameters(x_train, y_train):
     action_text = 'Tune hyperparameters'
     start_action(action_text)
 
-    param_tuner = GridSearchCV(MLPClassifier(), param_grid=param_grid, n_jobs=-1, cv=5, verbose=1)
+    param_tuner = GridSearchCV(MLPClassifier(), param_grid=PARAM_GRID, n_jobs=-1, cv=CV_FOLDS, verbose=1)
     param_tuner.fit(x_train, y_train)
 
     end_action(action_text)
-    return param_tuner.best_estimator_
+    # only the final fit of the chosen configuration is comparable with an incremental retrain
+    return param_tuner.best_estimator_, param_tuner.refit_time_
+
+
+def train_trial(x_train, y_train, hyperparameters: dict):
+    action_text = f'Train trial {hyperparameters}'
+    start_action(action_text, span_name='Train trial')
+    mlflow.log_params(hyperparameters)
+
+    digit_classifier = MLPClassifier(**hyperparameters)
+
+    # the running mean is logged per fold so the sweep's early termination policy has intermediate values
+    fold_scores = []
+    for fold, (train_index, validation_index) in enumerate(StratifiedKFold(n_splits=CV_FOLDS).split(x_train, y_train)):
+        fold_classifier = clone(digit_classifier).fit(x_train[train_index], y_train[train_index])
+        fold_scores.append(fold_classifier.score(x_train[validation_index], y_train[validation_index]))
+        mlflow.log_metric(PRIMARY_METRIC, sum(fold_scores) / len(fold_scores), step=fold)
+
+    refit_start = time.perf_counter()
+    digit_classifier.fit(x_train, y_train)
+    refit_seconds = time.perf_counter() - refit_start
+
+    end_action(action_text)
+    return digit_classifier, refit_seconds
+
+
+def continue_training(digit_classifier, x_new, y_new, epochs: int):
+    action_text = f'Continue training on {len(y_new)} new or changed rows'
+    start_action(action_text, span_name='Continue training')
+    mlflow.log_param('new_or_changed_rows', len(y_new))
+
+    if digit_classifier.solver in ('adam', 'sgd'):
+        for _ in range(epochs):
+            digit_classifier.partial_fit(x_new, y_new)
+    else:
+        missing_classes = set(digit_classifier.classes_) - set(y_new)
+        if missing_classes:
+            end_action(action_text, state='failure')
+            raise ValueError(f'Warm start with the {digit_classifier.solver} solver requires new rows of every class '
+                             f'(missing: {sorted(missing_classes)}). Run a full training instead.')
+        digit_classifier.set_params(warm_start=True, max_iter=epochs)
+        digit_classifier.fit(x_new, y_new)
+
+    end_action(action_text)
+    return digit_classifier
+
+
+def report_time_saved(training_seconds: float, refit_seconds: float):
+    mlflow.log_metric('training_seconds', training_seconds)
+    if refit_seconds is None:
+        print(f'Incremental retraining took {training_seconds:.1f}s, duration of a full refit is unknown')
+        return
+
+    mlflow.log_metric('training_seconds_saved', refit_seconds - training_seconds)
+    print(f'Incremental retraining took {training_seconds:.1f}s instead of {refit_seconds:.1f}s '
+          f'for refitting the model on the full training set ({refit_seconds - training_seconds:.1f}s saved)')
+
+
+def validate_against_baseline(baseline_classifier, digit_classifier, x_test, y_test, max_accuracy_drop: float) -> bool:
+    action_text = 'Validate against latest registered model'
+    start_action(action_text)
+
+    baseline_accuracy = accuracy_score(y_test, baseline_classifier.predict(x_test), normalize=True)
+    accuracy = accuracy_score(y_test, digit_classifier.predict(x_test), normalize=True)
+    mlflow.log_metric('baseline_test_accuracy', baseline_accuracy)
+
+    if accuracy < baseline_accuracy - max_accuracy_drop:
+        end_action(f'Skipped registration, test accuracy dropped from {baseline_accuracy:.4f} to {accuracy:.4f}',
+                   state='skipped')
+        return False
+
+    end_action(f'{action_text} (test accuracy {baseline_accuracy:.4f} -> {accuracy:.4f})')
+    return True
 
 
 def analyze_model(digit_classifier, x_test, y_test):
@@ -127,5 +307,67 @@ def export_model(digit_classifier):
     end_action(action_text)
 
 
+def log_training_info(training_info: dict):
+    # kept on the run of every registered model version so incremental retraining knows its baseline
+    mlflow.set_tag('train_dataset_version', training_info['train_dataset_version'])
+    if training_info['refit_seconds'] is not None:
+        mlflow.log_metric('refit_seconds', training_info['refit_seconds'])
+
+
+def save_trial_model(digit_classifier, training_info: dict, model_output: str):
+    action_text = 'Save trial model'
+    start_action(action_text)
+
+    mlflow.sklearn.save_model(
+        sk_model=digit_classifier,
+        path=os.path.join(model_output, 'trained_model'),
+        conda_env=os.path.join('src', '1_conda_env.yml'),
+    )
+    with open(os.path.join(model_output, TRAINING_INFO_FILE_NAME), 'w') as training_info_file:
+        json.dump(training_info, training_info_file)
+
+    end_action(action_text)
+
+
+def load_trained_model(model_input: str) -> (MLPClassifier, dict):
+    action_text = 'Load model of best trial'
+    start_action(action_text)
+
+    digit_classifier = mlflow.sklearn.load_model(os.path.join(model_input, 'trained_model'))
+    with open(os.path.join(model_input, TRAINING_INFO_FILE_NAME)) as training_info_file:
+        training_info = json.load(training_info_file)
+
+    end_action(action_text)
+    return digit_classifier, training_info
+
+
+def load_latest_registered_model() -> (MLPClassifier, dict):
+    model_name = os.getenv('MODEL_NAME')
+    action_text = f'Load latest registered version of model "{model_name}"'
+    start_action(action_text, span_name='Load latest registered model')
+
+    client = MlflowClient()
+    model_versions = client.search_model_versions(f"name='{model_name}'")
+    if not model_versions:
+        end_action(action_text, state='failure')
+        raise RuntimeError(f'Model "{model_name}" has no registered version. Run a full training first.')
+
+    latest_model_version = max(model_versions, key=lambda m: int(m.version))
+    run = client.get_run(latest_model_version.run_id)
+    if 'train_dataset_version' not in run.data.tags:
+        end_action(action_text, state='failure')
+        raise RuntimeError(f'Version {latest_model_version.version} of model "{model_name}" does not record its '
+                           f'training set version. Run a full training first.')
+
+    digit_classifier = mlflow.sklearn.load_model(f'models:/{model_name}/{latest_model_version.version}')
+    training_info = {
+        'train_dataset_version': run.data.tags['train_dataset_version'],
+        'refit_seconds': run.data.metrics.get('refit_seconds'),
+    }
+
+    end_action(action_text)
+    return digit_classifier, training_info
+
+
 if __name__ == '__main__':
     main()
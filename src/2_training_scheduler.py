@@ -1,15 +1,27 @@
+import argparse
 import os
 
-from azure.ai.ml import MLClient, command
-from azure.identity import DefaultAzureCredential
 from dotenv import load_dotenv
 
+from hyperparameters import PARAM_GRID, PRIMARY_METRIC, grid_combinations, to_argument_name, to_search_space
 from utils import start_action, end_action
 
 load_dotenv('.env')
 
+EXPERIMENT_NAME = 'train_digit_classifier_model'
+EARLY_TERMINATION_POLICIES = ['bandit', 'median', 'none']
+
 
 def main():
+    args = parse_arguments()
+
+    if args.dry_run:
+        print_job_graph(args)
+        return
+
+    from azure.ai.ml import MLClient
+    from azure.identity import DefaultAzureCredential
+
     ml_client = MLClient(
         credential=DefaultAzureCredential(),
         subscription_id=os.getenv('SUBSCRIPTION_ID'),
@@ -18,17 +30,131 @@ def main():
     )
 
     print()
-    action_text = 'Queue model training job'
+    if args.sweep:
+        queue_sweep_pipeline(ml_client, args.max_concurrent_trials, args.early_termination)
+    else:
+        queue_training_job(ml_client, args.incremental)
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Queue the digit classifier training in the AML Workspace')
+    training_mode = parser.add_mutually_exclusive_group()
+    training_mode.add_argument('--sweep', action='store_true',
+                               help='Run one sweep trial per hyperparameter combination '
+                                    'instead of an in-job grid search')
+    training_mode.add_argument('--incremental', action='store_true',
+                               help='Continue training the latest registered model on new or changed rows only')
+    parser.add_argument('--max-concurrent-trials', type=int, default=2,
+                        help='Maximum number of sweep trials running at the same time')
+    parser.add_argument('--early-termination', choices=EARLY_TERMINATION_POLICIES, default='bandit',
+                        help='Policy used to stop poorly performing sweep trials early')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the job graph without connecting to Azure')
+    return parser.parse_args()
+
+
+def queue_training_job(ml_client, incremental: bool):
+    from azure.ai.ml import command
+
+    action_text = 'Queue incremental model training job' if incremental else 'Queue model training job'
     start_action(action_text)
 
-    environment = f'{os.getenv("ENVIRONMENT_NAME")}@latest'
-    compute_instance = os.getenv('COMPUTE_INSTANCE_NAME')
-    job = command(code='./', command='python ./src/2_training.py', environment=environment, compute=compute_instance,
-                  experiment_name='train_digit_classifier_model', display_name='Digit Classifier Model Training')
+    job = command(code='./', command=training_command(incremental), environment=environment_name(),
+                  compute=os.getenv('COMPUTE_INSTANCE_NAME'), experiment_name=EXPERIMENT_NAME,
+                  display_name='Digit Classifier Model Training')
 
     ml_client.jobs.create_or_update(job)
     end_action(action_text)
 
 
+def queue_sweep_pipeline(ml_client, max_concurrent_trials: int, early_termination: str):
+    from azure.ai.ml import command, dsl, Input, Output
+    from azure.ai.ml.sweep import Choice
+
+    action_text = 'Queue model training sweep'
+    start_action(action_text)
+
+    search_space = to_search_space(PARAM_GRID)
+    compute_instance = os.getenv('COMPUTE_INSTANCE_NAME')
+
+    train_trial = command(
+        code='./', command=trial_command(), environment=environment_name(), compute=compute_instance,
+        inputs={name: values[0] for name, values in search_space.items()},
+        outputs={'model_output': Output(type='uri_folder')},
+        display_name='Digit Classifier Model Training Trial',
+    )
+    register_best_trial = command(
+        code='./', command=register_command(), environment=environment_name(), compute=compute_instance,
+        inputs={'model_input': Input(type='uri_folder')},
+        display_name='Digit Classifier Model Registration',
+    )
+
+    @dsl.pipeline(compute=compute_instance, display_name='Digit Classifier Model Training Sweep')
+    def training_sweep_pipeline():
+        trial = train_trial(**{name: Choice(values=values) for name, values in search_space.items()})
+        sweep_step = trial.sweep(
+            primary_metric=PRIMARY_METRIC, goal='Maximize', sampling_algorithm='grid',
+            max_total_trials=len(grid_combinations(PARAM_GRID)), max_concurrent_trials=max_concurrent_trials,
+            early_termination_policy=create_early_termination_policy(early_termination),
+        )
+        register_best_trial(model_input=sweep_step.outputs.model_output)
+
+    ml_client.jobs.create_or_update(training_sweep_pipeline(), experiment_name=EXPERIMENT_NAME)
+    end_action(action_text)
+
+
+def create_early_termination_policy(early_termination: str):
+    from azure.ai.ml.sweep import BanditPolicy, MedianStoppingPolicy
+
+    # every trial reports the primary metric once per cross-validation fold
+    if early_termination == 'bandit':
+        return BanditPolicy(slack_factor=0.1, evaluation_interval=1, delay_evaluation=2)
+    elif early_termination == 'median':
+        return MedianStoppingPolicy(evaluation_interval=1, delay_evaluation=2)
+    elif early_termination == 'none':
+        return None
+    else:
+        raise ValueError(f'Early termination policy {early_termination} unhandled.')
+
+
+def environment_name() -> str:
+    return f'{os.getenv("ENVIRONMENT_NAME")}@latest'
+
+
+def training_command(incremental: bool) -> str:
+    return 'python ./src/2_training.py incremental' if incremental else 'python ./src/2_training.py'
+
+
+def trial_command() -> str:
+    arguments = ' '.join(f'{to_argument_name(name)} ${{{{inputs.{name}}}}}' for name in PARAM_GRID)
+    return f'python ./src/2_training.py trial {arguments} --model-output ${{{{outputs.model_output}}}}'
+
+
+def register_command() -> str:
+    return 'python ./src/2_training.py register --model-input ${{inputs.model_input}}'
+
+
+def print_job_graph(args: argparse.Namespace):
+    if args.incremental:
+        print('\nTraining job (incremental retraining of the latest registered model)')
+        print(f'  {training_command(incremental=True)}')
+        return
+    if not args.sweep:
+        print('\nTraining job (grid search within a single job)')
+        print(f'  {training_command(incremental=False)}')
+        return
+
+    combinations = grid_combinations(PARAM_GRID)
+    print(f'\nSweep (grid sampling, {len(combinations)} trials, '
+          f'max. {args.max_concurrent_trials} concurrent, early termination: {args.early_termination}, '
+          f'maximizing "{PRIMARY_METRIC}")')
+    print(f'  {trial_command()}')
+    for number, combination in enumerate(combinations, start=1):
+        print(f'  ├── trial {number:>2}: ' + ', '.join(f'{name}={value}' for name, value in combination.items()))
+    print('  ▼ outputs.model_output of best trial')
+    print('Registration job')
+    print(f'  {register_command()}')
+
+
 if __name__ == '__main__':
     main()
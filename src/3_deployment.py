@@ -6,6 +6,7 @@ from azure.identity import DefaultAzureCredential
 from azure.ai.ml.entities import ManagedOnlineEndpoint, ManagedOnlineDeployment
 import dotenv
 
+from instrumentation import trace
 from utils import execute_cli_command, start_action, end_action
 
 dotenv.load_dotenv('.env')
@@ -90,4 +91,5 @@ def update_environment_configuration(scoring_uri: str, deployment_name: str, api
 
 
 if __name__ == '__main__':
-    main()
+    with trace('3_deployment'):
+        main()
@@ -9,6 +9,7 @@ from azureml.core import Workspace, Dataset
 from dotenv import load_dotenv
 from sklearn.preprocessing import StandardScaler
 
+from instrumentation import trace
 from utils import start_action, end_action
 
 load_dotenv('.env')
@@ -92,4 +93,5 @@ def pretty_print_results(pred_samples, y_samples):
 
 
 if __name__ == '__main__':
-    main()
+    with trace('4_test_client'):
+        main()
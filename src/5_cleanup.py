@@ -1,29 +1,181 @@
 import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_for_futures
+from typing import Optional
 
 import dotenv
 
+from instrumentation import span, trace
 from utils import execute_cli_command, start_action, end_action
 
 dotenv.load_dotenv('.env')
 
+COMPLETED_STEPS_KEY = 'CLEANUP_COMPLETED_STEPS'
+POLL_INTERVAL_SECONDS = float(os.getenv('CLEANUP_POLL_INTERVAL_SECONDS', 15))
+RESOURCE_GROUP_DELETION_TIMEOUT_SECONDS = float(os.getenv('CLEANUP_RESOURCE_GROUP_DELETION_TIMEOUT_SECONDS', 45 * 60))
+
+# set on Ctrl+C, so steps waiting in the background stop instead of keeping the process alive
+_stop_requested = threading.Event()
+
 
 def main():
+    # step name: (function, steps it depends on)
+    # online_endpoints never fails, the resource group deletion removes endpoints it could not delete anyway
+    steps = {
+        'online_endpoints': (delete_online_endpoints, []),
+        'resource_group': (delete_resource_group, ['online_endpoints']),
+        'app_registration': (delete_app_registration, []),
+        'ml_extension': (remove_azure_cli_ml_extension, ['online_endpoints']),
+    }
+
     print()
-    delete_resource_group()
+    failed_steps = run_steps(steps)
+    if failed_steps:
+        print(f'\nCleanup incomplete, failed steps: {", ".join(failed_steps)}. '
+              f'Run the cleanup again to resume.')
+        quit(1)
+
+
+def run_steps(steps: dict) -> list:
+    completed_steps = load_completed_steps()
+    for step_name in steps:
+        if step_name in completed_steps:
+            end_action(f'Skipped "{step_name}", completed by a previous run', state='skipped')
+
+    pending_steps = [step_name for step_name in steps if step_name not in completed_steps]
+    failed_steps = []
+    running_steps = {}
+    executor = ThreadPoolExecutor(max_workers=len(steps))
+    try:
+        while pending_steps or running_steps:
+            for step_name in list(pending_steps):
+                step_function, dependencies = steps[step_name]
+                if any(dependency in failed_steps for dependency in dependencies):
+                    pending_steps.remove(step_name)
+                    failed_steps.append(step_name)
+                    end_action(f'Skipped "{step_name}", a step it depends on failed', state='skipped')
+                elif all(dependency in completed_steps for dependency in dependencies):
+                    pending_steps.remove(step_name)
+                    running_steps[executor.submit(run_step, step_name, step_function)] = step_name
+
+            if not running_steps:
+                break
+
+            finished_futures, _ = wait_for_futures(running_steps, return_when=FIRST_COMPLETED)
+            for future in finished_futures:
+                step_name = running_steps.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    failed_steps.append(step_name)
+                    end_action(f'Step "{step_name}" failed: {str(error).strip()}', state='failure')
+                else:
+                    record_completed_step(completed_steps, step_name)
+    except BaseException:
+        _stop_requested.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+    executor.shutdown()
+    return failed_steps
+
+
+def run_step(step_name: str, step_function):
+    with span(step_name):
+        step_function()
+
+
+def load_completed_steps() -> list:
+    return [step_name for step_name in os.getenv(COMPLETED_STEPS_KEY, '').split(',') if step_name]
+
+
+def record_completed_step(completed_steps: list, step_name: str):
+    completed_steps.append(step_name)
+    dotenv.set_key(os.path.join('./', '.env'), COMPLETED_STEPS_KEY, ','.join(completed_steps))
+
+
+def resource_group_exists(resource_group_name: str) -> bool:
+    return execute_cli_command(f'az group exists' +
+                               f' --name {resource_group_name}') == 'true'
+
+
+def resource_group_provisioning_state(resource_group_name: str) -> Optional[str]:
+    if not resource_group_exists(resource_group_name):
+        return None
+
+    try:
+        return execute_cli_command(f'az group show' +
+                                   f' --name {resource_group_name}' +
+                                   f' --query "properties.provisioningState"')
+    except RuntimeError:
+        # the deletion may have finished in between
+        if not resource_group_exists(resource_group_name):
+            return None
+        raise
+
+
+def delete_online_endpoints():
+    resource_group_name = os.getenv('RESOURCE_GROUP')
+    action_text = 'Delete online endpoints to release their compute first'
+    start_action(action_text, in_parallel=True)
+
+    try:
+        if not resource_group_exists(resource_group_name):
+            end_action('Skipped online endpoint deletion, the resource group does not exist', state='skipped')
+            return
+
+        endpoint_names = execute_cli_command(f'az ml online-endpoint list' +
+                                             f' --resource-group {resource_group_name}' +
+                                             f' --workspace-name {os.getenv("AML_WORKSPACE_NAME")}' +
+                                             f' --query "[].name"')
+
+        with ThreadPoolExecutor(max_workers=max(len(endpoint_names), 1)) as executor:
+            list(executor.map(delete_online_endpoint, endpoint_names))
+    except RuntimeError as error:
+        end_action(f'Could not delete online endpoints, left to the resource group deletion: {str(error).strip()}',
+                   state='failure')
+        return
+
+    end_action(f'{action_text} ({len(endpoint_names)} deleted)')
 
-    delete_app_registration()
 
-    remove_azure_cli_ml_extension()
+def delete_online_endpoint(endpoint_name: str):
+    execute_cli_command(f'az ml online-endpoint delete' +
+                        f' --resource-group {os.getenv("RESOURCE_GROUP")}' +
+                        f' --workspace-name {os.getenv("AML_WORKSPACE_NAME")}' +
+                        f' --name {endpoint_name}' +
+                        f' --yes')
 
 
 def delete_resource_group():
     resource_group_name = os.getenv('RESOURCE_GROUP')
     action_text = f'Delete Resource Group "{resource_group_name}"'
-    start_action(action_text)
-
-    execute_cli_command(f'az group delete' +
-                        f' --name {resource_group_name}' +
-                        f' --yes')
+    start_action(action_text, in_parallel=True)
+
+    # a rerun may find the group already deleted or still deleting
+    provisioning_state = resource_group_provisioning_state(resource_group_name)
+    if provisioning_state not in (None, 'Deleting'):
+        execute_cli_command(f'az group delete' +
+                            f' --name {resource_group_name}' +
+                            f' --yes' +
+                            f' --no-wait')
+
+    deadline = time.monotonic() + RESOURCE_GROUP_DELETION_TIMEOUT_SECONDS
+    while provisioning_state is not None:
+        if time.monotonic() > deadline:
+            end_action(action_text, state='failure')
+            raise RuntimeError(f'Resource group "{resource_group_name}" is still being deleted after '
+                               f'{RESOURCE_GROUP_DELETION_TIMEOUT_SECONDS:.0f}s. Run the cleanup again to resume.')
+
+        if _stop_requested.wait(POLL_INTERVAL_SECONDS):
+            end_action(action_text, state='failure')
+            raise RuntimeError(f'Stopped waiting for the deletion of resource group "{resource_group_name}".')
+        provisioning_state = resource_group_provisioning_state(resource_group_name)
+        if provisioning_state not in (None, 'Deleting'):
+            end_action(action_text, state='failure')
+            raise RuntimeError(f'Deletion of resource group "{resource_group_name}" stopped in provisioning state '
+                               f'"{provisioning_state}".')
 
     end_action(action_text)
 
@@ -31,7 +183,11 @@ def delete_resource_group():
 def delete_app_registration():
     app_registration_id = os.getenv('AMLW_CLIENT_ID')
     action_text = 'Delete App Registration'
-    start_action(action_text)
+    start_action(action_text, in_parallel=True)
+
+    if not app_registration_exists(app_registration_id):
+        end_action('Skipped app registration deletion, it does not exist', state='skipped')
+        return
 
     execute_cli_command(f'az ad app delete' +
                         f' --id {app_registration_id}')
@@ -39,19 +195,34 @@ def delete_app_registration():
     end_action(action_text)
 
 
+def app_registration_exists(app_registration_id: str) -> bool:
+    try:
+        execute_cli_command(f'az ad app show' +
+                            f' --id {app_registration_id}')
+    except RuntimeError as error:
+        # a rerun may find the app registration already deleted
+        if 'does not exist' in str(error) or 'NotFound' in str(error):
+            return False
+        raise
+    return True
+
+
 def remove_azure_cli_ml_extension():
     added_extension = os.getenv('AZURE_CLI_ML_EXTENSION_ADDED')
     if added_extension == str(False):
         return
 
     action_text = 'Removing previously added ML extension of Azure CLI'
-    start_action(action_text)
+    start_action(action_text, in_parallel=True)
 
-    execute_cli_command('az extension remove' +
-                        ' --name ml')
+    if 'ml' in execute_cli_command('az extension list' +
+                                   ' --query "[].name"'):
+        execute_cli_command('az extension remove' +
+                            ' --name ml')
 
     end_action(action_text)
 
 
 if __name__ == '__main__':
-    main()
+    with trace('5_cleanup'):
+        main()
@@ -0,0 +1,235 @@
+import contextlib
+import importlib
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+FAKE_AZ_DIRECTORY = os.path.join(SOURCE_DIRECTORY, 'fake_az')
+CLEANUP_TIMEOUT_SECONDS = 30
+ALL_STEPS = ['online_endpoints', 'resource_group', 'app_registration', 'ml_extension']
+
+INITIAL_STATE = {
+    'calls': [],
+    'failing_commands': [],
+    'group_state': 'Succeeded',
+    'group_state_after_deletion': None,
+    'deleting_polls_left': 2,
+    'endpoints': ['endpoint-a', 'endpoint-b'],
+    'app_registration': 'app-registration-id',
+    'ml_extension': True,
+}
+
+DOTENV_CONTENT = ("RESOURCE_GROUP='rg-azure-ml-showcase-check'\n" +
+                  "AML_WORKSPACE_NAME='mlw-mlshowcase-check'\n" +
+                  "AMLW_CLIENT_ID='app-registration-id'\n" +
+                  "AZURE_CLI_ML_EXTENSION_ADDED='True'\n")
+
+
+def main():
+    checks = [
+        check_happy_path,
+        check_resume_after_failure,
+        check_endpoint_failure_does_not_block_resource_group,
+        check_failed_resource_group_deletion,
+        check_already_deleted_app_registration,
+        check_resource_group_deletion_deadline,
+        check_failed_dependency_is_skipped,
+        check_interrupt_stops_polling,
+    ]
+
+    failed_checks = []
+    print()
+    for check in checks:
+        with tempfile.TemporaryDirectory() as working_directory:
+            try:
+                check(working_directory)
+                print(f'🟢 {check.__name__}')
+            except AssertionError as error:
+                failed_checks.append(check.__name__)
+                print(f'🔴 {check.__name__}: {error}')
+
+    if failed_checks:
+        sys.exit(1)
+
+
+def check_happy_path(working_directory: str):
+    state, cleanup = run_cleanup(working_directory, INITIAL_STATE)
+
+    assert cleanup.returncode == 0, output_of(cleanup)
+    assert state['group_state'] is None, 'resource group was not deleted'
+    assert state['endpoints'] == [], 'online endpoints were not deleted'
+    assert state['app_registration'] is None, 'app registration was not deleted'
+    assert not state['ml_extension'], 'ml extension was not removed'
+    assert sorted(completed_steps(working_directory)) == sorted(ALL_STEPS), completed_steps(working_directory)
+    assert last_call(state, 'ml online-endpoint delete') < state['calls'].index('group delete'), \
+        'resource group deletion started before the online endpoints were deleted'
+
+
+def check_resume_after_failure(working_directory: str):
+    state, cleanup = run_cleanup(working_directory, {**INITIAL_STATE, 'failing_commands': ['ad app delete']})
+
+    assert cleanup.returncode == 1, output_of(cleanup)
+    assert state['group_state'] is None, 'independent resource group deletion did not finish'
+    assert 'app_registration' not in completed_steps(working_directory), 'failed step was recorded as completed'
+
+    state, cleanup = run_cleanup(working_directory, {**state, 'calls': [], 'failing_commands': []})
+
+    assert cleanup.returncode == 0, output_of(cleanup)
+    assert state['calls'] == ['ad app show', 'ad app delete'], f'rerun did not only resume the failed step: {state["calls"]}'
+    assert sorted(completed_steps(working_directory)) == sorted(ALL_STEPS), completed_steps(working_directory)
+
+
+def check_endpoint_failure_does_not_block_resource_group(working_directory: str):
+    state, cleanup = run_cleanup(working_directory,
+                                 {**INITIAL_STATE, 'failing_commands': ['ml online-endpoint list']})
+
+    assert cleanup.returncode == 0, output_of(cleanup)
+    assert state['group_state'] is None, 'resource group was not deleted'
+    assert not state['ml_extension'], 'ml extension was not removed'
+
+
+def check_failed_resource_group_deletion(working_directory: str):
+    state, cleanup = run_cleanup(working_directory, {**INITIAL_STATE, 'group_state_after_deletion': 'Succeeded'})
+
+    assert cleanup.returncode == 1, output_of(cleanup)
+    assert 'resource_group' not in completed_steps(working_directory), 'failed step was recorded as completed'
+    assert 'app_registration' in completed_steps(working_directory), 'independent step did not complete'
+
+
+def check_already_deleted_app_registration(working_directory: str):
+    state, cleanup = run_cleanup(working_directory, {**INITIAL_STATE, 'app_registration': None})
+
+    assert cleanup.returncode == 0, output_of(cleanup)
+    assert 'ad app delete' not in state['calls'], 'deletion of a missing app registration was attempted'
+    assert sorted(completed_steps(working_directory)) == sorted(ALL_STEPS), completed_steps(working_directory)
+
+
+def check_resource_group_deletion_deadline(working_directory: str):
+    state, cleanup = run_cleanup(working_directory, {**INITIAL_STATE, 'deleting_polls_left': 10 ** 6},
+                                 CLEANUP_RESOURCE_GROUP_DELETION_TIMEOUT_SECONDS='0.5')
+
+    assert cleanup.returncode == 1, output_of(cleanup)
+    assert state['group_state'] == 'Deleting'
+    assert 'resource_group' not in completed_steps(working_directory), 'timed out step was recorded as completed'
+
+
+def check_failed_dependency_is_skipped(working_directory: str):
+    # the step graph of 5_cleanup has no hard dependencies, so the scheduling is checked with a made-up one
+    def fail():
+        raise RuntimeError('simulated failure')
+
+    executed_steps = []
+    steps = {
+        'first': (fail, []),
+        'second': (lambda: executed_steps.append('second'), ['first']),
+        'independent': (lambda: executed_steps.append('independent'), []),
+    }
+
+    previous_directory = os.getcwd()
+    os.chdir(working_directory)
+    os.environ.pop('CLEANUP_COMPLETED_STEPS', None)
+    try:
+        cleanup_module = importlib.import_module('5_cleanup')
+        with contextlib.redirect_stdout(io.StringIO()):
+            failed_steps = cleanup_module.run_steps(steps)
+    finally:
+        os.chdir(previous_directory)
+
+    assert sorted(failed_steps) == ['first', 'second'], failed_steps
+    assert executed_steps == ['independent'], executed_steps
+    assert completed_steps(working_directory) == ['independent'], completed_steps(working_directory)
+
+
+def check_interrupt_stops_polling(working_directory: str):
+    state_file, command, environment = prepare_cleanup(working_directory,
+                                                       {**INITIAL_STATE, 'deleting_polls_left': 10 ** 6})
+    cleanup = subprocess.Popen(command, cwd=working_directory, env=environment,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + CLEANUP_TIMEOUT_SECONDS
+        while read_state(state_file)['group_state'] != 'Deleting':
+            assert time.monotonic() < deadline, 'resource group deletion did not start'
+            time.sleep(0.05)
+
+        cleanup.send_signal(signal.SIGINT)
+        try:
+            cleanup.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            raise AssertionError('cleanup kept polling after Ctrl+C')
+    finally:
+        cleanup.kill()
+
+    assert cleanup.returncode != 0, 'interrupted cleanup reported success'
+    assert 'resource_group' not in completed_steps(working_directory), 'interrupted step was recorded as completed'
+
+
+def run_cleanup(working_directory: str, initial_state: dict,
+                **environment_overrides) -> (dict, subprocess.CompletedProcess):
+    state_file, command, environment = prepare_cleanup(working_directory, initial_state, **environment_overrides)
+    try:
+        cleanup = subprocess.run(command, cwd=working_directory, env=environment, timeout=CLEANUP_TIMEOUT_SECONDS,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    except subprocess.TimeoutExpired:
+        raise AssertionError(f'cleanup did not finish within {CLEANUP_TIMEOUT_SECONDS}s')
+
+    return read_state(state_file), cleanup
+
+
+def prepare_cleanup(working_directory: str, initial_state: dict, **environment_overrides) -> (str, list, dict):
+    state_file = os.path.join(working_directory, 'fake_az_state.json')
+    with open(state_file, 'w') as file:
+        json.dump(initial_state, file)
+
+    dotenv_file = os.path.join(working_directory, '.env')
+    if not os.path.exists(dotenv_file):
+        with open(dotenv_file, 'w') as file:
+            file.write(DOTENV_CONTENT)
+
+    environment = {key: value for key, value in os.environ.items()
+                   if key not in ['RESOURCE_GROUP', 'AML_WORKSPACE_NAME', 'AMLW_CLIENT_ID',
+                                  'AZURE_CLI_ML_EXTENSION_ADDED', 'CLEANUP_COMPLETED_STEPS']}
+    environment.update({
+        'PATH': FAKE_AZ_DIRECTORY + os.pathsep + environment.get('PATH', ''),
+        'FAKE_AZ_STATE': state_file,
+        'TRACE_FILE': os.path.join(working_directory, 'trace.jsonl'),
+        'CLEANUP_POLL_INTERVAL_SECONDS': '0.05',
+        **environment_overrides,
+    })
+    return state_file, [sys.executable, os.path.join(SOURCE_DIRECTORY, '5_cleanup.py')], environment
+
+
+def read_state(state_file: str) -> dict:
+    # the fake az rewrites the file under a lock, so an unlocked read may catch it empty
+    for _ in range(10):
+        with open(state_file) as file:
+            content = file.read()
+        if content:
+            return json.loads(content)
+        time.sleep(0.01)
+    raise AssertionError(f'state file {state_file} stayed empty')
+
+
+def completed_steps(working_directory: str) -> list:
+    with open(os.path.join(working_directory, '.env')) as file:
+        for line in file:
+            if line.startswith('CLEANUP_COMPLETED_STEPS='):
+                return [step for step in line.split('=', 1)[1].strip().strip("'").split(',') if step]
+    return []
+
+
+def last_call(state: dict, command: str) -> int:
+    return max(index for index, call in enumerate(state['calls']) if call == command)
+
+
+def output_of(process: subprocess.CompletedProcess) -> str:
+    return f'exit code {process.returncode}\n{process.stdout}'
+
+
+if __name__ == '__main__':
+    main()
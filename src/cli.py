@@ -0,0 +1,53 @@
+import argparse
+import importlib
+import sys
+from types import ModuleType
+
+# script modules are imported only once their subcommand runs, so every command pays just for its own dependencies
+# command: (script module, help text, traced by the CLI, script parses its own arguments)
+COMMANDS = {
+    'provision': ('1_resource_creator', 'Create all Azure resources and register the MNIST dataset', True, False),
+    'train': ('2_training', 'Train the digit classifier (runs within the AML job)', False, True),
+    'schedule': ('2_training_scheduler', 'Queue the model training in the AML Workspace', False, True),
+    'deploy': ('3_deployment', 'Deploy the latest registered model to an online endpoint', True, False),
+    'test': ('4_test_client', 'Predict test samples using the published endpoint', True, False),
+    'cleanup': ('5_cleanup', 'Delete all previously created Azure resources', True, False),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Azure Machine Learning showcase for digit classification')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, (_, help_text, _, parses_arguments) in COMMANDS.items():
+        # scripts with their own parser receive all options, including --help
+        subparsers.add_parser(command, help=help_text, description=help_text, add_help=not parses_arguments)
+
+    args, command_arguments = parser.parse_known_args()
+    _, _, _, parses_arguments = COMMANDS[args.command]
+    if command_arguments and not parses_arguments:
+        parser.error(f'command {args.command} takes no arguments: {" ".join(command_arguments)}')
+
+    run_command(args.command, command_arguments)
+
+
+def load_command(command: str) -> ModuleType:
+    module_name, _, _, _ = COMMANDS[command]
+    return importlib.import_module(module_name)
+
+
+def run_command(command: str, command_arguments: list):
+    _, _, traced, _ = COMMANDS[command]
+    sys.argv = [f'{sys.argv[0]} {command}'] + command_arguments
+    module = load_command(command)
+
+    if traced:
+        from instrumentation import trace
+
+        with trace(module.__name__):
+            module.main()
+    else:
+        module.main()
+
+
+if __name__ == '__main__':
+    main()
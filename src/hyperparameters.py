@@ -0,0 +1,48 @@
+import itertools
+from typing import Union
+
+PARAM_GRID = {
+    'hidden_layer_sizes': [(100,), (125,), (100, 100)],
+    'activation': ['logistic', 'relu'],
+    'solver': ['lbfgs'],
+    'alpha': [1E-4, 1E-3],
+
+    'max_iter': [500],
+}
+
+CV_FOLDS = 5
+PRIMARY_METRIC = 'cv_accuracy'
+
+SweepValue = Union[str, int, float]
+
+
+def encode_value(value) -> SweepValue:
+    # AML sweep choices only accept primitives, so layer tuples travel as "100,100"
+    if isinstance(value, tuple):
+        return ','.join(str(size) for size in value)
+    return value
+
+
+def decode_hidden_layer_sizes(value: str) -> tuple:
+    return tuple(int(size) for size in value.split(',') if size)
+
+
+def argument_type(values: list):
+    # the type of a trial argument follows the grid values, layer tuples are decoded from their encoded form
+    if isinstance(values[0], tuple):
+        return decode_hidden_layer_sizes
+    return type(values[0])
+
+
+def to_search_space(param_grid: dict) -> dict:
+    return {name: [encode_value(value) for value in values] for name, values in param_grid.items()}
+
+
+def grid_combinations(param_grid: dict) -> list:
+    search_space = to_search_space(param_grid)
+    names = list(search_space)
+    return [dict(zip(names, values)) for values in itertools.product(*search_space.values())]
+
+
+def to_argument_name(name: str) -> str:
+    return '--' + name.replace('_', '-')
@@ -0,0 +1,257 @@
+import functools
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+import psutil
+
+TRACE_FILE = os.getenv('TRACE_FILE', 'trace.jsonl')
+RSS_SAMPLING_INTERVAL_SECONDS = 0.1
+
+_active_tracer = None
+_span_sequence = itertools.count()
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional['Span'], manual: bool):
+        self.name = name
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.path = name if parent is None else f'{parent.path}/{name}'
+        # spans opened by start_action may only be closed by end_action
+        self.manual = manual
+        self.state = None
+        self.sequence = next(_span_sequence)
+        self.start_time = time.time()
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_bytes = 0
+        self._wall_start = time.perf_counter()
+        # spans of worker threads only count their own thread, the main thread counts the whole process
+        self.cpu_scope = 'process' if threading.current_thread() is threading.main_thread() else 'thread'
+        self._cpu_clock = _cpu_seconds if self.cpu_scope == 'process' else time.thread_time
+        self._cpu_start = self._cpu_clock()
+
+    def finish(self, state: str):
+        self.state = state
+        self.wall_seconds = time.perf_counter() - self._wall_start
+        self.cpu_seconds = self._cpu_clock() - self._cpu_start
+
+    def to_record(self) -> dict:
+        return {
+            'name': self.name,
+            'path': self.path,
+            'depth': self.depth,
+            'state': self.state,
+            'start_time': self.start_time,
+            'wall_seconds': round(self.wall_seconds, 6),
+            'cpu_seconds': round(self.cpu_seconds, 6),
+            'cpu_scope': self.cpu_scope,
+            'peak_rss_mb': round(self.peak_rss_bytes / 2 ** 20, 1),
+        }
+
+
+class JsonlSink:
+    def __init__(self, trace_file: str = TRACE_FILE):
+        self.trace_file = trace_file
+
+    def record(self, trace_id: str, span: Span):
+        with open(self.trace_file, 'a') as trace_file:
+            trace_file.write(json.dumps({'trace_id': trace_id, **span.to_record()}) + '\n')
+
+
+class MlflowSink:
+    def record(self, trace_id: str, span: Span):
+        import mlflow
+
+        if mlflow.active_run() is None:
+            return
+
+        metric_prefix = 'span/' + '/'.join(_to_metric_name(name) for name in span.path.split('/'))
+        mlflow.log_metrics({
+            f'{metric_prefix}/wall_seconds': span.wall_seconds,
+            f'{metric_prefix}/cpu_seconds': span.cpu_seconds,
+            f'{metric_prefix}/peak_rss_mb': span.peak_rss_bytes / 2 ** 20,
+        })
+
+
+class Tracer:
+    def __init__(self, sink):
+        self.trace_id = str(uuid.uuid4())[:8]
+        self.sink = sink
+        self.finished_spans = []
+        self._root_span = None
+        # every thread nests its spans on its own stack below the root span
+        self._open_spans = {}
+        self._lock = threading.Lock()
+        self._sink_lock = threading.Lock()
+        self._process = psutil.Process()
+        self._stop_sampling = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+
+    def open(self, name: str, manual: bool = False) -> Span:
+        with self._lock:
+            open_spans = self._open_spans.setdefault(threading.get_ident(), [])
+            parent = open_spans[-1] if open_spans else self._root_span
+            span = Span(name, parent, manual)
+            span.peak_rss_bytes = self._current_rss()
+            open_spans.append(span)
+            self._root_span = self._root_span or span
+        return span
+
+    def close(self, span: Span, state: str):
+        # spans left open inside the closed one (e.g. a start_action without end_action) are closed with it
+        with self._lock:
+            open_spans = self._open_spans.get(threading.get_ident(), [])
+            if span not in open_spans:
+                return
+            closed_spans = []
+            while True:
+                open_span = open_spans.pop()
+                closed_spans.append(open_span)
+                if open_span is span:
+                    break
+        with self._sink_lock:
+            for closed_span in closed_spans:
+                closed_span.finish(state if closed_span is span else 'failure')
+                self.finished_spans.append(closed_span)
+                self.sink.record(self.trace_id, closed_span)
+
+    def innermost_manual_span(self) -> Optional[Span]:
+        with self._lock:
+            open_spans = self._open_spans.get(threading.get_ident(), [])
+            if open_spans and open_spans[-1].manual:
+                return open_spans[-1]
+        return None
+
+    def start_sampling(self):
+        self._sampler.start()
+
+    def stop_sampling(self):
+        self._stop_sampling.set()
+        self._sampler.join()
+
+    def _sample_rss(self):
+        while not self._stop_sampling.wait(RSS_SAMPLING_INTERVAL_SECONDS):
+            rss = self._current_rss()
+            with self._lock:
+                for open_spans in self._open_spans.values():
+                    for span in open_spans:
+                        span.peak_rss_bytes = max(span.peak_rss_bytes, rss)
+
+    def _current_rss(self) -> int:
+        # worker processes (e.g. GridSearchCV with n_jobs=-1) count towards the footprint of a span
+        rss = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+
+@contextmanager
+def trace(name: str, sink=None):
+    global _active_tracer
+    tracer = Tracer(sink or JsonlSink())
+    previous_tracer, _active_tracer = _active_tracer, tracer
+    tracer.start_sampling()
+    root_span = tracer.open(name)
+    try:
+        yield tracer
+        tracer.close(root_span, 'success')
+    except BaseException:
+        tracer.close(root_span, 'failure')
+        raise
+    finally:
+        tracer.stop_sampling()
+        _active_tracer = previous_tracer
+        print_summary(tracer.finished_spans)
+
+
+@contextmanager
+def span(name: str):
+    if _active_tracer is None:
+        yield None
+        return
+
+    tracer = _active_tracer
+    opened_span = tracer.open(name)
+    try:
+        yield opened_span
+        tracer.close(opened_span, 'success')
+    except BaseException:
+        tracer.close(opened_span, 'failure')
+        raise
+
+
+def instrumented(name: Optional[str] = None):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def open_manual_span(name: str):
+    if _active_tracer is not None:
+        _active_tracer.open(name, manual=True)
+
+
+def close_manual_span(state: str):
+    if _active_tracer is None:
+        return
+    manual_span = _active_tracer.innermost_manual_span()
+    if manual_span is not None:
+        _active_tracer.close(manual_span, state)
+
+
+def print_summary(finished_spans: list):
+    if not finished_spans:
+        return
+
+    # depth-first, so spans of parallel threads stay grouped below their parents
+    children = {}
+    for finished_span in sorted(finished_spans, key=lambda s: s.sequence):
+        children.setdefault(finished_span.parent, []).append(finished_span)
+    spans, unvisited = [], list(reversed(children.get(None, [])))
+    while unvisited:
+        spans.append(unvisited.pop())
+        unvisited.extend(reversed(children.get(spans[-1], [])))
+
+    total_seconds = max(s.wall_seconds for s in spans if s.depth == 0) or 1E-9
+    rows = [
+        ('  ' * s.depth + s.name, f'{s.wall_seconds:.2f}', f'{s.cpu_seconds:.2f}', s.cpu_scope,
+         f'{s.peak_rss_bytes / 2 ** 20:.0f}', f'{100 * s.wall_seconds / total_seconds:.1f}', s.state)
+        for s in spans
+    ]
+    header = ('Span', 'Wall [s]', 'CPU [s]', 'CPU scope', 'Peak RSS [MB]', 'Share [%]', 'State')
+    widths = [max(len(row[column]) for row in rows + [header]) for column in range(len(header))]
+
+    def format_row(row):
+        cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:-1], widths[1:-1])]
+        return '│ ' + ' │ '.join(cells + [row[-1].ljust(widths[-1])]) + ' │'
+
+    print('\n┌─' + '─┬─'.join('─' * width for width in widths) + '─┐')
+    print(format_row(header))
+    print('├─' + '─┼─'.join('─' * width for width in widths) + '─┤')
+    for row in rows:
+        print(format_row(row))
+    print('└─' + '─┴─'.join('─' * width for width in widths) + '─┘')
+
+
+def _cpu_seconds() -> float:
+    cpu_times = psutil.Process().cpu_times()
+    return cpu_times.user + cpu_times.system + cpu_times.children_user + cpu_times.children_system
+
+
+def _to_metric_name(name: str) -> str:
+    return re.sub(r'[^0-9a-z]+', '_', name.lower()).strip('_')[:60]
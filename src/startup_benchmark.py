@@ -0,0 +1,107 @@
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+HEAVY_PACKAGES = ['azure', 'azureml', 'sklearn', 'pandas', 'numpy', 'mlflow', 'matplotlib', 'PIL']
+
+CLI = '(cli)'
+
+# import time added on top of a bare interpreter, in milliseconds
+# (None: measured but not enforced, so these commands may fail on a missing heavy package without failing the benchmark)
+STARTUP_BUDGETS_MS = {
+    CLI: 50,
+    'cleanup': 150,
+    'schedule': 150,
+    'provision': None,
+    'train': None,
+    'deploy': None,
+    'test': None,
+}
+LIGHTWEIGHT_COMMANDS = [CLI, 'cleanup', 'schedule']
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+MISSING_MODULE_LINE = re.compile(r"^ModuleNotFoundError: No module named '([^'.]+)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the startup import time of the CLI commands against budgets')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per command, the median is compared')
+    args = parser.parse_args()
+
+    interpreter_ms = measure('pass', args.repeat)[0]
+
+    violations, unenforced_failures = [], []
+    print('\n┌────────────┬──────────────┬─────────────┬──────────────────────────┐\n' +
+          '│ Command    │ Startup [ms] │ Budget [ms] │ Heavy packages           │\n' +
+          '├────────────┼──────────────┼─────────────┼──────────────────────────┤')
+    for command, budget_ms in STARTUP_BUDGETS_MS.items():
+        try:
+            import_ms, packages = measure(import_code(command), args.repeat)
+        except RuntimeError as error:
+            print(f'│ {command:<10} │ {"failed":>12} │ {budget_ms or "-":>11} │ {"-":<24} │')
+            failure = f'{command}: {str(error).strip().splitlines()[-1]}'
+            if budget_ms is None and missing_heavy_package(str(error)):
+                unenforced_failures.append(failure)
+            else:
+                violations.append(failure)
+            continue
+
+        startup_ms = import_ms - interpreter_ms
+        heavy_packages = sorted(package for package in packages if package in HEAVY_PACKAGES)
+        print(f'│ {command:<10} │ {startup_ms:>12.1f} │ {budget_ms or "-":>11} │ '
+              f'{", ".join(heavy_packages) or "-":<24} │')
+
+        if budget_ms is not None and startup_ms > budget_ms:
+            violations.append(f'{command}: startup of {startup_ms:.1f} ms exceeds budget of {budget_ms} ms')
+        if command in LIGHTWEIGHT_COMMANDS and heavy_packages:
+            violations.append(f'{command}: imports {", ".join(heavy_packages)} at startup')
+    print('└────────────┴──────────────┴─────────────┴──────────────────────────┘')
+
+    for failure in unenforced_failures:
+        print(f'🔵 {failure} (not enforced)')
+    for violation in violations:
+        print(f'🔴 {violation}')
+    if violations:
+        sys.exit(1)
+
+
+def missing_heavy_package(error_output: str) -> bool:
+    match = MISSING_MODULE_LINE.match(error_output.strip().splitlines()[-1])
+    return match is not None and match.group(1) in HEAVY_PACKAGES
+
+
+def import_code(command: str) -> str:
+    if command == CLI:
+        return 'import cli'
+    return f'import cli; cli.load_command({command!r})'
+
+
+def measure(code: str, repeat: int) -> (float, set):
+    runs_ms, packages = [], set()
+    for _ in range(repeat):
+        completed_process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if completed_process.returncode != 0:
+            raise RuntimeError(completed_process.stderr)
+
+        total_us = 0
+        for line in completed_process.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match is None:
+                continue
+            cumulative_us, indentation, package = int(match.group(2)), match.group(3), match.group(4)
+            packages.add(package.split('.')[0])
+            # nested imports are already contained in the cumulative time of their top-level import
+            if len(indentation) == 1:
+                total_us += cumulative_us
+        runs_ms.append(total_us / 1000)
+
+    return statistics.median(runs_ms), packages
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 import json
-from matplotlib import figure as Figure
-from PIL import Image as PILImage
+from instrumentation import open_manual_span, close_manual_span
 import subprocess
 import time
-from typing import Union
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from matplotlib import figure as Figure
+    from PIL import Image as PILImage
 
 CONSOLE_COLOR_RESET_CODE = '\x1b[0m'
 
@@ -27,8 +30,11 @@ def execute_cli_command(command: str) -> Union[str, list, dict]:
         return output
 
 
-def start_action(action_text: str):
-    print(f'⚪ {action_text}', end='')
+def start_action(action_text: str, in_parallel: bool = False, span_name: str = None):
+    # span names become metric keys, so action texts with changing values pass a stable span name
+    open_manual_span(span_name or action_text)
+    # actions running in parallel get their own line, otherwise their output would overwrite each other
+    print(f'⚪ {action_text}' + ('\n' if in_parallel else ''), end='')
 
 
 def end_action(action_text: str, state: str = 'success'):
@@ -41,6 +47,7 @@ def end_action(action_text: str, state: str = 'success'):
     else:
         raise ValueError(f'State {state} unhandled.')
 
+    close_manual_span(state)
     print(f'\r{status_symbol} {action_text}')
 
 
@@ -57,7 +64,10 @@ def request_user_consent(question: str) -> bool:
     return len(response) == 0 or response.lower() == 'y'
 
 
-def matplotlib_figure_to_pillow_image(figure: Figure, not_drawn_before: bool = True) -> PILImage:
+def matplotlib_figure_to_pillow_image(figure: 'Figure', not_drawn_before: bool = True) -> 'PILImage':
+    # imported here so scripts without plots do not pay for Pillow at startup
+    from PIL import Image as PILImage
+
     if not_drawn_before:
         figure.canvas.draw()
     return PILImage.frombytes('RGB', figure.canvas.get_width_height(), figure.canvas.tostring_rgb())